@@ -1,15 +1,16 @@
 import os
 import logging
-from . import db, auth, jokes, moderator, logging_routes  
+from . import db, auth, jokes, moderator, logging_routes, replica, shards, dedup, scheduler, maintenance
 from logging.handlers import RotatingFileHandler
 from flask import Flask, g, redirect, url_for, render_template
 import click
 from werkzeug.security import generate_password_hash
-from .db import get_db
+from .auth import create_user, find_user
+from .shards import shard_for_id
 
 def setup_logging(app):
     # Log directory setup
-    log_dir = os.path.join(app.instance_path, 'logs')
+    log_dir = app.config['LOG_DIR']
     os.makedirs(log_dir, exist_ok=True)
 
     # Logging file handler (rotating)
@@ -56,13 +57,33 @@ def setup_logging(app):
             return f"Log level set to {level}", 200
         return "Invalid log level", 400
 
-def create_app():
+def create_app(test_config=None):
     # Create/Configure app
     app = Flask(__name__, instance_relative_config=True)
     app.config.from_mapping(
         SECRET_KEY='dev',
         DATABASE=os.path.join(app.instance_path, 'flaskr.sqlite'),
+        LOG_DIR=os.path.join(app.instance_path, 'logs'),
+        # Read-only snapshot used for moderator and reporting reads (None disables it)
+        REPLICA_DATABASE=os.path.join(app.instance_path, 'flaskr-replica.sqlite'),
+        REPLICA_REFRESH_INTERVAL=30,
+        REPLICA_MAX_STALENESS=120,
+        # User-scoped rows are routed to shard files by (id - 1) % SHARD_BUCKETS
+        SHARD_BUCKETS=64,
+        SHARD_MAP=os.path.join(app.instance_path, 'shard_map.json'),
+        SHARD_FANOUT_WORKERS=8,
+        # Estimated similarity of word-pair shingles at which a submission counts as
+        # a repost; 0.6 catches a one-word insertion or substitution in most jokes
+        DEDUP_THRESHOLD=0.6,
+        # Background jobs; one process at a time holds the lease and runs them
+        SCHEDULER_ENABLED=True,
+        SCHEDULER_WORKERS=2,
+        SCHEDULER_TICK=5,
+        SCHEDULER_LEASE_SECONDS=30,
+        JOB_INTERVALS={},
     )
+    if test_config is not None:
+        app.config.from_mapping(test_config)
 
     # Ensure instance folder exists
     try: os.makedirs(app.instance_path)
@@ -81,6 +102,11 @@ def create_app():
         return render_template('base.html')  # Load the main content if logged in
 
     db.init_app(app)
+    shards.init_app(app)
+    scheduler.init_app(app)
+    maintenance.init_app(app)
+    replica.init_app(app)
+    dedup.init_app(app)
     app.add_url_rule("/", endpoint="index")
 
     
@@ -106,20 +132,17 @@ def create_app():
     @click.argument('email')
     def init_moderator_command(username, email):
         """Initialize a moderator user."""
-        db = get_db()
-        
-        user = db.execute('SELECT * FROM user WHERE email = ?', (email,)).fetchone()
+        user = find_user(email)
         if user:
+            db = shard_for_id(user['id'])
             db.execute('UPDATE user SET role = ? WHERE email = ?', ('Moderator', email))
+            db.commit()
             click.echo(f'Updated user {username} ({email}) to Moderator role.')
         else:
             password = input("Enter Password for Moderator: ")
-            db.execute(
-                'INSERT INTO user (email, nickname, password, role) VALUES (?, ?, ?, ?)',
-                (email, username, generate_password_hash(password), 'Moderator')
-            )
+            if create_user(email, username, generate_password_hash(password), 'Moderator') is None:
+                click.echo(f'Nickname {username} is already taken.')
+                return
             click.echo(f'Created new moderator user: {username} ({email})')
-        
-        db.commit()
 
     return app
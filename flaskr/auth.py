@@ -1,20 +1,60 @@
 import functools
+import sqlite3
 from flask import (
     Blueprint, flash, g, redirect, render_template, request, session, url_for, current_app
 )
 from werkzeug.security import check_password_hash, generate_password_hash
 from flaskr.db import get_db
+from flaskr.shards import allocate_id, bucket_for_key, get_shard, shard_for_id, shard_map
 from .logging_utils import log_auth_success, log_auth_failure, log_role_change
 
 bp = Blueprint('auth', __name__, url_prefix='/auth')
 
+def find_user(email_or_nickname):
+    """User row for an email or nickname, found through the user directory on shard 0."""
+    entry = get_db().execute(
+        'SELECT user_id FROM user_directory WHERE email = ? OR nickname = ?', (email_or_nickname, email_or_nickname)
+    ).fetchone()
+    if entry is None:
+        return None
+    return shard_for_id(entry['user_id']).execute(
+        'SELECT * FROM user WHERE id = ?', (entry['user_id'],)
+    ).fetchone()
+
+def create_user(email, nickname, password_hash, role='User'):
+    """Add a user on its home shard. Returns the new id, or None if the email or nickname is taken.
+
+    Users on different shards can't share a UNIQUE index, so the email and
+    nickname are claimed in the user directory on shard 0 in the same flow.
+    """
+    bucket = bucket_for_key(email)
+    db = get_shard(shard_map()[bucket])
+    directory = get_db()
+    user_id = allocate_id(db, 'user', bucket)
+    try:
+        directory.execute(
+            'INSERT INTO user_directory (user_id, email, nickname) VALUES (?, ?, ?)', (user_id, email, nickname)
+        )
+    except sqlite3.IntegrityError:
+        db.rollback()
+        directory.rollback()
+        return None
+
+    db.execute(
+        'INSERT INTO user (id, email, nickname, password, role, joke_balance) VALUES (?, ?, ?, ?, ?, 0)',
+        (user_id, email, nickname, password_hash, role)
+    )
+    # The directory commits first, so a crash in between leaves a name reserved rather than duplicated
+    directory.commit()
+    db.commit()
+    return user_id
+
 @bp.route('/register', methods=('GET', 'POST'))
 def register():
     if request.method == 'POST':
         email = request.form['email']
         nickname = request.form['nickname']
         password = request.form['password']
-        db = get_db()
         error = None
 
         if not email:
@@ -27,17 +67,10 @@ def register():
             error = 'Password is required.'
             current_app.logger.warning("User registration failed: Missing password.")
 
-        elif db.execute(
-            'SELECT id FROM user WHERE email = ? OR nickname = ?', (email, nickname)
-        ).fetchone() is not None:
+        elif create_user(email, nickname, generate_password_hash(password)) is None:
             error = 'Email or Nickname already exists.'
 
         if error is None:
-            db.execute(
-                'INSERT INTO user (email, nickname, password, joke_balance) VALUES (?, ?, ?, 0)',
-                (email, nickname, generate_password_hash(password))
-            )
-            db.commit()
             return redirect(url_for('auth.login'))
 
         flash(error)
@@ -49,11 +82,8 @@ def login():
     if request.method == 'POST':
         email_or_nickname = request.form['email_or_nickname']
         password = request.form['password']
-        db = get_db()
         error = None
-        user = db.execute(
-            'SELECT * FROM user WHERE email = ? OR nickname = ?', (email_or_nickname, email_or_nickname)
-        ).fetchone()
+        user = find_user(email_or_nickname)
 
         if user is None:
             error = 'Incorrect email or nickname.'
@@ -80,7 +110,7 @@ def load_logged_in_user():
     if user_id is None:
         g.user = None
     else:
-        g.user = get_db().execute(
+        g.user = shard_for_id(user_id).execute(
             'SELECT id, email, nickname, password, joke_balance, role FROM user WHERE id = ?',
             (user_id,)
         ).fetchone()
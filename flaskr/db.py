@@ -2,14 +2,40 @@ import sqlite3
 from flask import current_app, g
 
 def init_db():
-    db = get_db()
+    from .shards import all_shards
 
     with current_app.open_resource('schema.sql') as f:
-        db.executescript(f.read().decode('utf8'))
+        schema = f.read().decode('utf8')
+
+    for db in all_shards():
+        db.executescript(schema)
+
+def upgrade_db():
+    from .maintenance import recompute_ratings
+    from .shards import all_shards
+
+    with current_app.open_resource('upgrade.sql') as f:
+        upgrade = f.read().decode('utf8')
+
+    for db in all_shards():
+        db.executescript(upgrade)
+
+    # Claim the emails and nicknames of users created before the user directory
+    directory = get_db()
+    for db in all_shards():
+        directory.executemany(
+            'INSERT OR IGNORE INTO user_directory (user_id, email, nickname) VALUES (?, ?, ?)',
+            db.execute('SELECT id, email, nickname FROM user').fetchall()
+        )
+    directory.commit()
+
+    # Start the running rating totals from the takes recorded so far
+    recompute_ratings()
 
 def init_app(app):
     app.teardown_appcontext(close_db)
     app.cli.add_command(init_db_command)
+    app.cli.add_command(upgrade_db_command)
 
 import click
 @click.command('init-db')
@@ -18,6 +44,12 @@ def init_db_command():
     init_db()
     click.echo('Initialized the database.')
 
+@click.command('upgrade-db')
+def upgrade_db_command():
+    """Add tables introduced since the database was created, keeping existing data."""
+    upgrade_db()
+    click.echo('Upgraded the database.')
+
 
 def get_db() -> sqlite3.Connection:
     if 'db' not in g:
@@ -26,6 +58,8 @@ def get_db() -> sqlite3.Connection:
             detect_types=sqlite3.PARSE_DECLTYPES
         )
         g.db.row_factory = sqlite3.Row
+        # Readers don't block the writer in WAL mode; the checkpoint job keeps the log short
+        g.db.execute('PRAGMA journal_mode=WAL')
 
     return g.db
 
@@ -0,0 +1,313 @@
+import hashlib
+import random
+import re
+import statistics
+import time
+import tracemalloc
+from array import array
+from itertools import groupby, repeat
+from operator import add, and_, itemgetter, mul
+
+import click
+from flask import current_app
+
+from .db import get_db
+from .scheduler import register_job
+from .shards import bucket_of, fan_out, get_shard, merge_scan, shard_count, shard_map
+
+NUM_PERM = 64
+BANDS = 16
+ROWS_PER_BAND = NUM_PERM // BANDS
+# Word pairs rather than triples: one added or changed word disturbs fewer shingles,
+# so small edits stay above DEDUP_THRESHOLD while unrelated jokes stay far below it
+SHINGLE_WORDS = 2
+# LSH candidates compared per shard when checking a submission
+MAX_CANDIDATES = 32
+# Keeps IN (...) lists under SQLite's bound parameter limit
+CHUNK_SIZE = 500
+
+# Each "permutation" is h -> (a * h + b) mod 2**64 on 64-bit shingle hashes. Chained
+# map() calls keep the min() loops in C, so a signature costs well under a millisecond.
+# Only the top 32 bits of each minimum are kept, which is what makes the ordering random.
+_MASK64 = (1 << 64) - 1
+_rng = random.Random(1009)
+_PERMUTATIONS = [(_rng.getrandbits(64) | 1, _rng.getrandbits(64)) for _ in range(NUM_PERM)]
+
+_NON_WORD = re.compile(r'[^\w\s]+')
+
+
+def init_app(app):
+    register_job(app, 'dedup_clusters', 60 * 60, compute_clusters, 'Group near-duplicate jokes for moderators')
+    app.cli.add_command(dedup_backfill_command)
+    app.cli.add_command(dedup_bench_command)
+
+
+def normalize(body):
+    """Lowercase, drop punctuation and collapse whitespace."""
+    return ' '.join(_NON_WORD.sub(' ', body.lower()).split())
+
+
+def _hash64(data, signed=True):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'big', signed=signed)
+
+
+def _shingles(text):
+    words = text.split()
+    if len(words) <= SHINGLE_WORDS:
+        return {text}
+    return {' '.join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+
+
+def signature(body):
+    """Return (body_hash, minhash) for a joke body."""
+    # Bodies of only emoji or punctuation normalize to nothing; compare those verbatim
+    text = normalize(body) or body.strip()
+    hashes = [_hash64(shingle.encode('utf8'), signed=False) for shingle in _shingles(text)]
+    minhash = array('I', [
+        min(map(and_, map(add, map(mul, hashes, repeat(a)), repeat(b)), repeat(_MASK64))) >> 32
+        for a, b in _PERMUTATIONS
+    ])
+    return _hash64(text.encode('utf8')), minhash
+
+
+def band_keys(minhash):
+    return [
+        _hash64(minhash[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND].tobytes())
+        for band in range(BANDS)
+    ]
+
+
+def similarity(a, b):
+    """Estimated Jaccard similarity of two MinHash signatures."""
+    return sum(x == y for x, y in zip(a, b)) / NUM_PERM
+
+
+def store_signature(db, joke_id, body):
+    """Index a joke body; the caller commits together with the joke row."""
+    body_hash, minhash = signature(body)
+    db.execute(
+        'INSERT OR REPLACE INTO joke_signature (joke_id, body_hash, signature) VALUES (?, ?, ?)',
+        (joke_id, body_hash, minhash.tobytes())
+    )
+    db.execute('DELETE FROM joke_lsh WHERE joke_id = ?', (joke_id,))
+    db.executemany(
+        'INSERT INTO joke_lsh (band, bucket, joke_id) VALUES (?, ?, ?)',
+        [(band, key, joke_id) for band, key in enumerate(band_keys(minhash))]
+    )
+
+
+def delete_signature(db, joke_id):
+    db.execute('DELETE FROM joke_signature WHERE joke_id = ?', (joke_id,))
+    db.execute('DELETE FROM joke_lsh WHERE joke_id = ?', (joke_id,))
+
+
+def find_duplicate(body, exclude_id=None):
+    """Id of an existing joke with the same or a near-identical body, or None.
+
+    One query per shard fetches the first exact match and up to
+    MAX_CANDIDATES jokes sharing an LSH band; an exact match wins.
+    """
+    if not body.strip():
+        return None
+
+    body_hash, minhash = signature(body)
+    bands = ' OR '.join(['(band = ? AND bucket = ?)'] * BANDS)
+    params = [value for band, key in enumerate(band_keys(minhash)) for value in (band, key)]
+    candidates = fan_out(
+        'SELECT joke_id, body_hash, signature FROM joke_signature WHERE joke_id = ('
+        'SELECT joke_id FROM joke_signature WHERE body_hash = ? AND joke_id IS NOT ? LIMIT 1) '
+        'UNION ALL '
+        'SELECT joke_id, body_hash, signature FROM joke_signature WHERE joke_id IN ('
+        f'SELECT DISTINCT joke_id FROM joke_lsh WHERE ({bands}) AND joke_id IS NOT ? LIMIT ?)',
+        [body_hash, exclude_id] + params + [exclude_id, MAX_CANDIDATES],
+        parallel=False
+    )
+
+    for row in candidates:
+        if row['body_hash'] == body_hash:
+            return row['joke_id']
+    threshold = current_app.config['DEDUP_THRESHOLD']
+    for row in candidates:
+        if similarity(minhash, array('I', row['signature'])) >= threshold:
+            return row['joke_id']
+    return None
+
+
+def _load_signatures(joke_ids, signatures):
+    """Add the MinHash bytes of the given jokes to `signatures`, reading only those not already there."""
+    by_shard = {}
+    for joke_id in joke_ids:
+        if joke_id not in signatures:
+            by_shard.setdefault(shard_map()[bucket_of(joke_id)], []).append(joke_id)
+
+    for index, ids in by_shard.items():
+        for i in range(0, len(ids), CHUNK_SIZE):
+            chunk = ids[i:i + CHUNK_SIZE]
+            marks = ', '.join('?' * len(chunk))
+            for row in get_shard(index).execute(
+                f'SELECT joke_id, signature FROM joke_signature WHERE joke_id IN ({marks})', chunk
+            ):
+                signatures[row['joke_id']] = row['signature']
+
+
+def compute_clusters():
+    """Rebuild joke_cluster: groups of jokes whose bodies are (near) duplicates.
+
+    The signature index is walked in body hash order and then in LSH bucket
+    order, one group at a time; only candidate duplicates and their signatures
+    are kept, so memory grows with the number of duplicates rather than with
+    the table. Jokes sharing a body hash are duplicates
+    outright. Within an LSH bucket every pair not already in one cluster is
+    compared, with identical signatures collapsed first.
+    """
+    threshold = current_app.config['DEDUP_THRESHOLD']
+    signatures = {}
+    parent = {}
+    def find(x):
+        while parent.setdefault(x, x) != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for _, rows in groupby(
+        merge_scan('SELECT body_hash, joke_id FROM joke_signature ORDER BY body_hash', key=itemgetter('body_hash')),
+        key=itemgetter('body_hash')
+    ):
+        first, *others = [row['joke_id'] for row in rows]
+        for other in others:
+            parent[find(other)] = find(first)
+
+    band_bucket = itemgetter('band', 'bucket')
+    for _, rows in groupby(
+        merge_scan('SELECT band, bucket, joke_id FROM joke_lsh ORDER BY band, bucket', key=band_bucket),
+        key=band_bucket
+    ):
+        members = [row['joke_id'] for row in rows]
+        if len(members) < 2:
+            continue
+
+        _load_signatures(members, signatures)
+        distinct = {}
+        for joke_id in members:
+            sig = signatures.get(joke_id)
+            if sig is None:
+                continue
+            if sig in distinct:
+                parent[find(joke_id)] = find(distinct[sig])
+            else:
+                distinct[sig] = joke_id
+        unique = [(joke_id, array('I', sig)) for sig, joke_id in distinct.items()]
+        for i, (a, sig_a) in enumerate(unique):
+            for b, sig_b in unique[i + 1:]:
+                if find(a) != find(b) and similarity(sig_a, sig_b) >= threshold:
+                    parent[find(b)] = find(a)
+
+    roots = {joke_id: find(joke_id) for joke_id in parent}
+    sizes = {}
+    for root in roots.values():
+        sizes[root] = sizes.get(root, 0) + 1
+
+    db = get_db()
+    db.execute('DELETE FROM joke_cluster')
+    db.executemany(
+        'INSERT INTO joke_cluster (joke_id, cluster) VALUES (?, ?)',
+        [(joke_id, root) for joke_id, root in roots.items() if sizes[root] > 1]
+    )
+    db.commit()
+
+
+def duplicate_clusters(page=1, per_page=20):
+    """One page of duplicate clusters as lists of joke ids, largest first, and whether more follow."""
+    db = get_db()
+    clusters = [row['cluster'] for row in db.execute(
+        'SELECT cluster FROM joke_cluster GROUP BY cluster ORDER BY COUNT(*) DESC, cluster LIMIT ? OFFSET ?',
+        (per_page + 1, (page - 1) * per_page)
+    )]
+    has_more = len(clusters) > per_page
+    clusters = clusters[:per_page]
+
+    members = {cluster: [] for cluster in clusters}
+    if clusters:
+        marks = ', '.join('?' * len(clusters))
+        for row in db.execute(
+            f'SELECT joke_id, cluster FROM joke_cluster WHERE cluster IN ({marks}) ORDER BY joke_id', clusters
+        ):
+            members[row['cluster']].append(row['joke_id'])
+    return list(members.values()), has_more
+
+
+@click.command('dedup-backfill')
+@click.option('--batch-size', default=500, help='Jokes indexed per transaction.')
+def dedup_backfill_command(batch_size):
+    """Index existing jokes for duplicate detection in streaming batches, then rebuild the clusters."""
+    tracemalloc.start()
+    started = time.perf_counter()
+    total = 0
+
+    for index in range(shard_count()):
+        db = get_shard(index)
+        last_id = 0
+        while True:
+            rows = db.execute(
+                'SELECT j.id, j.body FROM joke j LEFT JOIN joke_signature s ON s.joke_id = j.id '
+                'WHERE s.joke_id IS NULL AND j.id > ? ORDER BY j.id LIMIT ?',
+                (last_id, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                store_signature(db, row['id'], row['body'])
+            db.commit()
+            last_id = rows[-1]['id']
+            total += len(rows)
+
+    elapsed = time.perf_counter() - started
+    rate = total / elapsed if elapsed else 0
+    click.echo(f'Indexed {total} jokes in {elapsed:.2f}s ({rate:.0f} jokes/s).')
+
+    started = time.perf_counter()
+    compute_clusters()
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    click.echo(f'Rebuilt duplicate clusters in {elapsed:.2f}s. Peak memory {peak / 1024:.0f} KiB.')
+
+
+def _edit_one_word(body):
+    words = body.split()
+    middle = len(words) // 2
+    return ' '.join(words[:middle] + ['really'] + words[middle:])
+
+
+def _new_body(body):
+    # The same words in reverse order share no word pairs with the original
+    return ' '.join(reversed(body.split()))
+
+
+@click.command('dedup-bench')
+@click.option('--samples', default=200, help='Joke bodies to check per case.')
+def dedup_bench_command(samples):
+    """Time duplicate checks against the current index for new, edited and reposted jokes."""
+    bodies = [row['body'] for row in fan_out('SELECT body FROM joke LIMIT ?', (samples,))][:samples]
+    if not bodies:
+        click.echo('No jokes to check.')
+        return
+
+    # Untimed pass so the first case doesn't pay for cold page and statement caches
+    for body in bodies[:20]:
+        find_duplicate(_new_body(body))
+
+    for label, make_body in (('new joke', _new_body), ('one-word edit', _edit_one_word), ('exact repost', str)):
+        latencies = []
+        found = 0
+        for body in bodies:
+            probe = make_body(body)
+            start = time.perf_counter()
+            found += find_duplicate(probe) is not None
+            latencies.append((time.perf_counter() - start) * 1e6)
+        latencies.sort()
+
+        click.echo(
+            f'{label:<14} {len(latencies)} checks: median={statistics.median(latencies):.0f}us '
+            f'p95={latencies[int(len(latencies) * 0.95) - 1]:.0f}us, {found} flagged'
+        )
@@ -2,12 +2,13 @@ from flask import (
     Blueprint, flash, g, redirect, render_template, request, url_for, abort, current_app
 )
 from flaskr.auth import login_required
-from flaskr.db import get_db
+from flaskr.dedup import delete_signature, find_duplicate, store_signature
+from flaskr.shards import allocate_id, bucket_of, fan_out, shard_for_id
 
 bp = Blueprint('jokes', __name__, url_prefix='/jokes')
 
 def get_joke(id):
-    db = get_db()
+    db = shard_for_id(id)
     joke = db.execute(
         'SELECT j.id, title, body, created, author_id, nickname'
         ' FROM joke j JOIN user u ON j.author_id = u.id'
@@ -29,7 +30,7 @@ def leave_joke():
     if request.method == 'POST':
         title = request.form['title']
         body = request.form['body']
-        db = get_db()
+        db = shard_for_id(g.user['id'])
         error = None
 
         if not title:
@@ -41,12 +42,17 @@ def leave_joke():
             'SELECT id FROM joke WHERE title = ? AND author_id = ?', (title, g.user['id'])
         ).fetchone() is not None:
             error = 'You have already used this title for a joke.'
+        elif find_duplicate(body) is not None:
+            error = 'This joke has already been posted.'
+            current_app.logger.info(f"Duplicate joke submission rejected: '{title}' by {g.user['nickname']}")
 
         if error is None:
+            joke_id = allocate_id(db, 'joke', bucket_of(g.user['id']))
             db.execute(
-                'INSERT INTO joke (title, body, author_id) VALUES (?, ?, ?)',
-                (title, body, g.user['id'])
+                'INSERT INTO joke (id, title, body, author_id) VALUES (?, ?, ?, ?)',
+                (joke_id, title, body, g.user['id'])
             )
+            store_signature(db, joke_id, body)
             db.execute(
                 'UPDATE user SET joke_balance = joke_balance + 1 WHERE id = ?',
                 (g.user['id'],)
@@ -63,33 +69,42 @@ def leave_joke():
 @login_required
 def rate_joke(id):
     rating = int(request.form['rating'])
-    db = get_db()
+    db = shard_for_id(g.user['id'])
+    taken = db.execute(
+        'SELECT rating FROM joke_taken WHERE joke_id = ? AND user_id = ?', (id, g.user['id'])
+    ).fetchone()
+    if taken is None:
+        return redirect(request.referrer)
     
     # Update the rating in joke_taken
     db.execute(
         'UPDATE joke_taken SET rating = ? WHERE joke_id = ? AND user_id = ?',
         (rating, id, g.user['id'])
     )
-    
-    # Calculate and update average rating in joke table
-    avg_rating = db.execute(
-        'SELECT AVG(rating) as avg_rating FROM joke_taken WHERE joke_id = ? AND rating IS NOT NULL',
-        (id,)
-    ).fetchone()['avg_rating']
-    
-    if avg_rating is not None:
-        db.execute(
-            'UPDATE joke SET rating = ? WHERE id = ?',
-            (avg_rating, id)
-        )
-    
     db.commit()
+    
+    # Keep a running total next to the joke instead of summing takes on every shard;
+    # the ratings job recomputes it from the takes in case the two shards drift apart
+    joke_db = shard_for_id(id)
+    previous = taken['rating']
+    joke_db.execute(
+        'INSERT INTO joke_rating (joke_id, rating_total, rating_count) VALUES (?, ?, ?) '
+        'ON CONFLICT (joke_id) DO UPDATE SET rating_total = rating_total + excluded.rating_total, '
+        'rating_count = rating_count + excluded.rating_count',
+        (id, rating - (previous or 0), 0 if previous is not None else 1)
+    )
+    joke_db.execute(
+        'UPDATE joke SET rating = (SELECT 1.0 * rating_total / rating_count FROM joke_rating '
+        'WHERE joke_id = ? AND rating_count > 0) WHERE id = ?',
+        (id, id)
+    )
+    joke_db.commit()
     return redirect(request.referrer)
 
 @bp.route('/my_jokes')
 @login_required
 def my_jokes():
-    db = get_db()
+    db = shard_for_id(g.user['id'])
     jokes = db.execute(
         'SELECT id, title, body, rating, created FROM joke WHERE author_id = ? ORDER BY created DESC',
         (g.user['id'],)
@@ -99,18 +114,18 @@ def my_jokes():
 @bp.route('/take')
 @login_required
 def take_joke():
-    db = get_db()
-    # Get all jokes not authored by current user
-    jokes = db.execute(
+    db = shard_for_id(g.user['id'])
+    # Get all jokes not authored by current user from every shard, newest first
+    jokes = fan_out(
         'SELECT j.id, j.title, j.body, j.rating, j.created, '
-        '(SELECT nickname FROM user WHERE id = j.author_id) as author_nickname, '
-        '(SELECT rating FROM joke_taken WHERE joke_id = j.id AND user_id = ?) as user_rating, '
-        'EXISTS(SELECT 1 FROM joke_taken WHERE joke_id = j.id AND user_id = ?) as is_taken '
+        '(SELECT nickname FROM user WHERE id = j.author_id) as author_nickname '
         'FROM joke j '
         'WHERE j.author_id != ? '
         'ORDER BY j.created DESC',
-        (g.user['id'], g.user['id'], g.user['id'])
-    ).fetchall()
+        (g.user['id'],),
+        order_by='created',
+        reverse=True
+    )
     
     # Get list of jokes already taken by user
     taken_jokes = db.execute(
@@ -125,8 +140,9 @@ def take_joke():
 @login_required
 def delete(id):
     get_joke(id)
-    db = get_db()
+    db = shard_for_id(g.user['id'])
     db.execute('DELETE FROM joke WHERE id = ?', (id,))
+    delete_signature(db, id)
     db.execute(
         'UPDATE user SET joke_balance = joke_balance - 1 WHERE id = ?',
         (g.user['id'],)
@@ -145,13 +161,16 @@ def edit(id):
 
         if not body:
             error = 'Body is required.'
+        elif find_duplicate(body, exclude_id=id) is not None:
+            error = 'This joke has already been posted.'
 
         if error is None:
-            db = get_db()
+            db = shard_for_id(g.user['id'])
             db.execute(
                 'UPDATE joke SET body = ? WHERE id = ? AND author_id = ?',
                 (body, id, g.user['id'])
             )
+            store_signature(db, id, body)
             db.commit()
             return redirect(url_for('jokes.view_joke', id = id))
 
@@ -162,7 +181,7 @@ def edit(id):
 @bp.route('/<int:id>/take', methods=['POST'])
 @login_required
 def take_single(id):
-    db = get_db()
+    db = shard_for_id(g.user['id'])
     
     # Check if user has enough joke balance
     if g.user['joke_balance'] <= 0:
@@ -178,7 +197,7 @@ def take_single(id):
         return redirect(url_for('jokes.take_joke'))
     
     # Check if joke exists and user isn't the author
-    joke = db.execute(
+    joke = shard_for_id(id).execute(
         'SELECT author_id FROM joke WHERE id = ?',
         (id,)
     ).fetchone()
@@ -207,13 +226,17 @@ def take_single(id):
 @bp.route('/<int:id>', methods=('GET',))
 @login_required
 def view_joke(id):
-    db = get_db()
-    is_taken = bool(db.execute("select exists(select * from joke_taken where user_id = ? and joke_id = ?) as is_taken", (g.user["id"], id)).fetchone()["is_taken"])
+    db = shard_for_id(g.user["id"])
+    taken = db.execute("select rating from joke_taken where user_id = ? and joke_id = ?", (g.user["id"], id)).fetchone()
+    is_taken = taken is not None
 
-    joke = db.execute(
-       "select *, (SELECT rating FROM joke_taken WHERE joke_id = j.id AND user_id = ?) as user_rating from joke j inner join user u on (u.id = j.author_id) where j.id = ?",
-        (g.user["id"], id),
+    joke = shard_for_id(id).execute(
+       "select j.*, u.nickname from joke j inner join user u on (u.id = j.author_id) where j.id = ?",
+        (id,),
     ).fetchone()
+    if joke is None:
+        abort(404)
+    joke = dict(joke, user_rating=taken["rating"] if is_taken else None)
 
     if not is_taken and g.user["id"] != joke["author_id"]:
         flash("you have not taken this joke")
@@ -0,0 +1,69 @@
+from .scheduler import register_job
+from .shards import all_shards, fan_out, shard_for_id
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+
+def init_app(app):
+    register_job(app, 'ratings', HOUR, recompute_ratings, 'Recompute joke ratings from all takes')
+    register_job(app, 'checkpoint', 5 * 60, checkpoint, 'Checkpoint and truncate WAL files')
+    register_job(app, 'optimize', HOUR, optimize, 'PRAGMA optimize on every shard')
+    register_job(app, 'analyze', DAY, analyze, 'Refresh query planner statistics')
+    register_job(app, 'vacuum', 7 * DAY, vacuum, 'Rebuild shard files to reclaim free pages')
+
+
+def recompute_ratings():
+    """Recompute every joke's rating total and average from the takes, which live on each taker's shard.
+
+    rate_joke keeps these up to date incrementally; this corrects any drift
+    between the takes and the totals, which are written to different shards.
+    """
+    totals = {}
+    for row in fan_out(
+        'SELECT joke_id, SUM(rating) as total, COUNT(rating) as count FROM joke_taken '
+        'WHERE rating IS NOT NULL GROUP BY joke_id'
+    ):
+        total, count = totals.get(row['joke_id'], (0, 0))
+        totals[row['joke_id']] = (total + row['total'], count + row['count'])
+
+    changed = set()
+    for joke_id, (total, count) in totals.items():
+        db = shard_for_id(joke_id)
+        written = db.execute(
+            'INSERT INTO joke_rating (joke_id, rating_total, rating_count) VALUES (?, ?, ?) '
+            'ON CONFLICT (joke_id) DO UPDATE SET rating_total = excluded.rating_total, '
+            'rating_count = excluded.rating_count WHERE rating_total != excluded.rating_total '
+            'OR rating_count != excluded.rating_count',
+            (joke_id, total, count)
+        ).rowcount
+        written += db.execute(
+            'UPDATE joke SET rating = ? WHERE id = ? AND rating IS NOT ?',
+            (total / count, joke_id, total / count)
+        ).rowcount
+        if written:
+            changed.add(db)
+    for db in changed:
+        db.commit()
+
+
+def checkpoint():
+    for db in all_shards():
+        db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+
+def optimize():
+    for db in all_shards():
+        db.execute('PRAGMA optimize')
+
+
+def analyze():
+    for db in all_shards():
+        db.execute('ANALYZE')
+        db.commit()
+
+
+def vacuum():
+    for db in all_shards():
+        db.execute('VACUUM')
+
@@ -1,16 +1,23 @@
+from datetime import datetime
 from flask import (
     Blueprint, flash, g, redirect, render_template, request, url_for, current_app
 )
 from flaskr.auth import moderator_required
 from flaskr.db import get_db
+from flaskr.dedup import CHUNK_SIZE, delete_signature, duplicate_clusters, store_signature
+from flaskr.replica import pin_primary, read_paths
+from flaskr.shards import fan_out, shard_for_id
 
 bp = Blueprint('moderator', __name__, url_prefix='/moderator')
 
 @bp.route('/dashboard')
 @moderator_required
 def dashboard():
-    db = get_db()
-    users = db.execute('SELECT id, email, nickname, role, joke_balance FROM user').fetchall()
+    users = fan_out(
+        'SELECT id, email, nickname, role, joke_balance FROM user ORDER BY id',
+        order_by='id',
+        paths=read_paths()
+    )
     return render_template('moderator/dashboard.html', users=users)
 
 @bp.route('/edit_balance/<int:user_id>', methods=['POST'])
@@ -22,12 +29,13 @@ def edit_balance(user_id):
             flash('Balance cannot be negative')
             return redirect(url_for('moderator.dashboard'))
             
-        db = get_db()
+        db = shard_for_id(user_id)
         db.execute(
             'UPDATE user SET joke_balance = ? WHERE id = ?',
             (new_balance, user_id)
         )
         db.commit()
+        pin_primary()
         
         current_app.logger.info(f"User balance updated for user_id {user_id} to {new_balance}")
         flash('Balance updated successfully')
@@ -51,7 +59,7 @@ def remove_joke():
 @bp.route('/toggle_role/<int:user_id>', methods=['POST'])
 @moderator_required
 def toggle_role(user_id):
-    db = get_db()
+    db = shard_for_id(user_id)
     
     # Check if target user exists
     target_user = db.execute('SELECT * FROM user WHERE id = ?', (user_id,)).fetchone()
@@ -60,10 +68,10 @@ def toggle_role(user_id):
         return redirect(url_for('moderator.dashboard'))
     
     # Count current moderators
-    moderator_count = db.execute(
+    moderator_count = sum(row['count'] for row in fan_out(
         'SELECT COUNT(*) as count FROM user WHERE role = ?', 
         ('Moderator',)
-    ).fetchone()['count']
+    ))
     
     new_role = 'User' if target_user['role'] == 'Moderator' else 'Moderator'
     
@@ -77,6 +85,7 @@ def toggle_role(user_id):
         (new_role, user_id)
     )
     db.commit()
+    pin_primary()
     
     current_app.logger.warning(
         f"User role changed: {target_user['email']} from {target_user['role']} to {new_role}"
@@ -87,18 +96,82 @@ def toggle_role(user_id):
 @bp.route('/jokes')
 @moderator_required
 def manage_jokes():
-    db = get_db()
-    jokes = db.execute(
+    jokes = fan_out(
         'SELECT j.*, u.nickname as author_nickname FROM joke j '
         'JOIN user u ON j.author_id = u.id '
-        'ORDER BY j.created DESC'
-    ).fetchall()
+        'ORDER BY j.created DESC',
+        order_by='created',
+        reverse=True,
+        paths=read_paths()
+    )
     return render_template('moderator/jokes.html', jokes=jokes)
 
+@bp.route('/duplicates')
+@moderator_required
+def duplicates():
+    page = max(request.args.get('page', 1, type=int), 1)
+    clusters, has_more = duplicate_clusters(page)
+    joke_ids = [joke_id for cluster in clusters for joke_id in cluster]
+    paths = read_paths()
+    jokes = {}
+    for i in range(0, len(joke_ids), CHUNK_SIZE):
+        chunk = joke_ids[i:i + CHUNK_SIZE]
+        marks = ', '.join('?' * len(chunk))
+        for joke in fan_out(
+            'SELECT j.id, j.title, j.body, j.created, u.nickname as author_nickname FROM joke j '
+            f'JOIN user u ON j.author_id = u.id WHERE j.id IN ({marks})',
+            chunk,
+            paths=paths
+        ):
+            jokes[joke['id']] = joke
+    clusters = [[jokes[joke_id] for joke_id in cluster if joke_id in jokes] for cluster in clusters]
+    return render_template(
+        'moderator/duplicates.html',
+        clusters=[c for c in clusters if len(c) > 1],
+        page=page,
+        has_more=has_more
+    )
+
+@bp.route('/jobs')
+@moderator_required
+def jobs():
+    db = get_db()
+    status = {row['name']: row for row in db.execute('SELECT * FROM job_status')}
+    lease = db.execute('SELECT owner, expires FROM scheduler_lease WHERE id = 1').fetchone()
+
+    def timestamp(seconds):
+        return datetime.fromtimestamp(seconds).strftime('%Y-%m-%d %H:%M:%S') if seconds else 'never'
+
+    jobs = []
+    for job in current_app.extensions['jobs'].values():
+        row = status.get(job.name)
+        runs = row['runs'] if row else 0
+        next_run = row['next_run'] if row else None
+        jobs.append({
+            'name': job.name,
+            'description': job.description,
+            'interval': job.interval,
+            'next_run': 'queued' if next_run == 0 else timestamp(next_run),
+            'last_started': timestamp(row['last_started'] if row else None),
+            'last_status': row['last_status'] if row else None,
+            'last_error': row['last_error'] if row else None,
+            'last_duration': row['last_duration'] if row else None,
+            'avg_duration': row['total_duration'] / runs if runs else None,
+            'max_duration': row['max_duration'] if runs else None,
+            'runs': runs,
+            'failures': row['failures'] if row else 0,
+        })
+    return render_template(
+        'moderator/jobs.html',
+        jobs=jobs,
+        leader=lease['owner'] if lease else None,
+        lease_expires=timestamp(lease['expires'] if lease else None)
+    )
+
 @bp.route('/joke/<int:joke_id>/edit', methods=['GET', 'POST'])
 @moderator_required
 def edit_joke(joke_id):
-    db = get_db()
+    db = shard_for_id(joke_id)
     if request.method == 'POST':
         title = request.form['title']
         body = request.form['body']
@@ -110,7 +183,9 @@ def edit_joke(joke_id):
                 'UPDATE joke SET title = ?, body = ? WHERE id = ?',
                 (title, body, joke_id)
             )
+            store_signature(db, joke_id, body)
             db.commit()
+            pin_primary()
             current_app.logger.info(f"Joke {joke_id} edited by moderator {g.user['email']}")
             flash('Joke updated successfully')
             return redirect(url_for('moderator.manage_jokes'))
@@ -121,9 +196,11 @@ def edit_joke(joke_id):
 @bp.route('/joke/<int:joke_id>/delete', methods=['POST'])
 @moderator_required
 def delete_joke(joke_id):
-    db = get_db()
+    db = shard_for_id(joke_id)
     db.execute('DELETE FROM joke WHERE id = ?', (joke_id,))
+    delete_signature(db, joke_id)
     db.commit()
+    pin_primary()
     current_app.logger.warning(f"Joke {joke_id} deleted by moderator {g.user['email']}")
     flash('Joke deleted successfully')
     return redirect(url_for('moderator.manage_jokes'))
@@ -0,0 +1,266 @@
+import multiprocessing
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+import click
+from flask import current_app, session
+
+from .scheduler import register_job
+from .shards import allocate_id, shard_file, shard_map, shard_paths
+
+
+def init_app(app):
+    register_job(
+        app, 'refresh_replica', app.config['REPLICA_REFRESH_INTERVAL'], refresh_replica,
+        'Copy every shard into its read-only replica'
+    )
+    app.cli.add_command(sync_replica_command)
+    app.cli.add_command(replica_bench_command)
+
+
+def sync_replica(primary_path, replica_path):
+    """Copy the primary database into the replica file with the online backup API.
+
+    The copy is made in a single step: a backup taken a few pages at a time is
+    restarted by every write to the primary and may never finish under load.
+    It goes into a temporary file which then atomically replaces the replica,
+    so readers never see a half-written file. The copy is switched from WAL to
+    rollback journaling so it is one self-contained file for read-only use.
+    """
+    if not os.path.exists(primary_path):
+        return False
+
+    started = time.time()
+    tmp_path = f'{replica_path}.{os.getpid()}.tmp'
+    src = sqlite3.connect(primary_path)
+    dst = sqlite3.connect(tmp_path)
+    try:
+        src.backup(dst)
+        dst.execute('PRAGMA journal_mode=DELETE')
+    finally:
+        dst.close()
+        src.close()
+
+    # Stamp the snapshot with the time the copy started so staleness is never underestimated
+    os.utime(tmp_path, (started, started))
+    os.replace(tmp_path, replica_path)
+    return True
+
+
+def replica_age(replica_path):
+    """Seconds since the replica snapshot was taken, or None if there is none."""
+    try:
+        return time.time() - os.path.getmtime(replica_path)
+    except OSError:
+        return None
+
+
+def sync_all():
+    """Refresh the replica of every shard."""
+    for index, primary_path in enumerate(shard_paths()):
+        sync_replica(primary_path, shard_file(current_app.config['REPLICA_DATABASE'], index))
+
+
+def refresh_replica():
+    if current_app.config.get('REPLICA_DATABASE'):
+        sync_all()
+
+
+def pin_primary():
+    """Serve this session's reads from the primary until the replica catches up with its writes."""
+    session['replica_pin'] = time.time()
+
+
+def read_paths():
+    """Files to read heavy read-only queries from, one per shard.
+
+    Each shard is read from its replica when that is fresh enough and from the
+    primary otherwise.
+    """
+    primaries = shard_paths()
+    replica_base = current_app.config.get('REPLICA_DATABASE')
+    if not replica_base:
+        return primaries
+
+    paths = []
+    for index, primary_path in enumerate(primaries):
+        replica_path = shard_file(replica_base, index)
+        age = replica_age(replica_path)
+        if age is None or age > current_app.config['REPLICA_MAX_STALENESS']:
+            current_app.logger.debug(f"Replica {replica_path} unavailable or stale (age={age}), reading from primary")
+            paths.append(primary_path)
+        elif session.get('replica_pin', 0) > time.time() - age:
+            paths.append(primary_path)
+        else:
+            paths.append(replica_path)
+
+    return paths
+
+
+@click.command('sync-replica')
+def sync_replica_command():
+    """Refresh the read-only replica from the primary database."""
+    if not current_app.config.get('REPLICA_DATABASE'):
+        click.echo('Replica is disabled (REPLICA_DATABASE is not set).')
+        return
+
+    sync_all()
+    click.echo('Replica synced.')
+
+
+REPORT_QUERY = (
+    'SELECT j.*, u.nickname as author_nickname FROM joke j '
+    'JOIN user u ON j.author_id = u.id '
+    'ORDER BY j.created DESC'
+)
+
+
+def _bench_reporter(paths, stop, ready):
+    """Run the moderator joke report against every shard until told to stop."""
+    conns = [sqlite3.connect(path, timeout=30) for path in paths]
+    ready.release()
+    while not stop.is_set():
+        for db in conns:
+            db.execute(REPORT_QUERY).fetchall()
+    for db in conns:
+        db.close()
+
+
+def _bench_taker(paths, layout, pairs):
+    """Take and rate jokes with the same statements as take_single and rate_joke.
+
+    Returns the latency of each take-and-rate in milliseconds.
+    """
+    conns = [sqlite3.connect(path, timeout=30) for path in paths]
+    for db in conns:
+        db.row_factory = sqlite3.Row
+
+    def shard(id):
+        return conns[layout[(id - 1) % len(layout)]]
+
+    latencies = []
+    for user_id, joke_id in pairs:
+        start = time.perf_counter()
+        db, joke_db = shard(user_id), shard(joke_id)
+
+        # take_single
+        db.execute('SELECT 1 FROM joke_taken WHERE user_id = ? AND joke_id = ?', (user_id, joke_id)).fetchone()
+        joke_db.execute('SELECT author_id FROM joke WHERE id = ?', (joke_id,)).fetchone()
+        db.execute('INSERT INTO joke_taken (user_id, joke_id) VALUES (?, ?)', (user_id, joke_id))
+        db.execute('UPDATE user SET joke_balance = joke_balance - 1 WHERE id = ?', (user_id,))
+        db.commit()
+
+        # rate_joke
+        rating = random.randint(1, 5)
+        previous = db.execute(
+            'SELECT rating FROM joke_taken WHERE joke_id = ? AND user_id = ?', (joke_id, user_id)
+        ).fetchone()['rating']
+        db.execute('UPDATE joke_taken SET rating = ? WHERE joke_id = ? AND user_id = ?', (rating, joke_id, user_id))
+        db.commit()
+        joke_db.execute(
+            'INSERT INTO joke_rating (joke_id, rating_total, rating_count) VALUES (?, ?, ?) '
+            'ON CONFLICT (joke_id) DO UPDATE SET rating_total = rating_total + excluded.rating_total, '
+            'rating_count = rating_count + excluded.rating_count',
+            (joke_id, rating - (previous or 0), 0 if previous is not None else 1)
+        )
+        joke_db.execute(
+            'UPDATE joke SET rating = (SELECT 1.0 * rating_total / rating_count FROM joke_rating '
+            'WHERE joke_id = ? AND rating_count > 0) WHERE id = ?',
+            (joke_id, joke_id)
+        )
+        joke_db.commit()
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    for db in conns:
+        db.close()
+    return latencies
+
+
+def _add_bench_users(conns, layout, count, balance):
+    """Create `count` users spread over every bucket on scratch shards and return their ids."""
+    user_ids = []
+    for n in range(count):
+        bucket = n % len(layout)
+        db = conns[layout[bucket]]
+        user_id = allocate_id(db, 'user', bucket)
+        db.execute(
+            'INSERT INTO user (id, email, nickname, password, joke_balance) VALUES (?, ?, ?, ?, ?)',
+            (user_id, f'bench{n}@bench', f'bench{n}', '-', balance)
+        )
+        db.commit()
+        user_ids.append(user_id)
+    return user_ids
+
+
+@click.command('replica-bench')
+@click.option('--writes', default=200, help='Takes and ratings per writer and scenario.')
+@click.option('--writers', default=2, help='Concurrent writer processes.')
+@click.option('--readers', default=2, help='Concurrent report processes.')
+def replica_bench_command(writes, writers, readers):
+    """Measure take-and-rate latency with heavy reports on the primary vs. the replica.
+
+    Works on a scratch copy of every shard, with extra users doing the taking.
+    """
+    layout = shard_map()
+    scenarios = (('no reports', None), ('reports on primary', 'primary'), ('reports on replica', 'replica'))
+    ctx = multiprocessing.get_context('spawn')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        primaries = [shard_file(os.path.join(tmp, 'primary.sqlite'), i) for i in range(len(shard_paths()))]
+        replicas = [shard_file(os.path.join(tmp, 'replica.sqlite'), i) for i in range(len(primaries))]
+        conns = []
+        for path, primary in zip(shard_paths(), primaries):
+            sync_replica(path, primary)
+            db = sqlite3.connect(primary)
+            db.row_factory = sqlite3.Row
+            db.execute('PRAGMA journal_mode=WAL')
+            conns.append(db)
+
+        jokes = [row['id'] for db in conns for row in db.execute('SELECT id FROM joke ORDER BY id')]
+        if not jokes:
+            click.echo('No jokes to take; leave some jokes first.')
+            return
+
+        # Each writer needs a fresh (user, joke) pair for every take in every scenario
+        per_writer = -(-writes * len(scenarios) // len(jokes))
+        users = _add_bench_users(conns, layout, per_writer * writers, writes * len(scenarios))
+        for db in conns:
+            db.close()
+        pairs = [
+            [(user_id, joke_id) for user_id in users[slot::writers] for joke_id in jokes]
+            for slot in range(writers)
+        ]
+        for primary, replica in zip(primaries, replicas):
+            sync_replica(primary, replica)
+
+        with ctx.Pool(writers) as pool:
+            for n, (label, target) in enumerate(scenarios):
+                stop, ready = ctx.Event(), ctx.Semaphore(0)
+                reporters = []
+                if target:
+                    paths = primaries if target == 'primary' else replicas
+                    reporters = [ctx.Process(target=_bench_reporter, args=(paths, stop, ready)) for _ in range(readers)]
+                    for reporter in reporters:
+                        reporter.start()
+                    for _ in reporters:
+                        ready.acquire()
+                try:
+                    results = pool.starmap(
+                        _bench_taker,
+                        [(primaries, layout, slot_pairs[n * writes:(n + 1) * writes]) for slot_pairs in pairs]
+                    )
+                finally:
+                    stop.set()
+                    for reporter in reporters:
+                        reporter.join()
+
+                latencies = sorted(latency for result in results for latency in result)
+                p95 = latencies[int(len(latencies) * 0.95) - 1]
+                click.echo(
+                    f'{label:<20} median={statistics.median(latencies):.2f}ms '
+                    f'p95={p95:.2f}ms max={latencies[-1]:.2f}ms'
+                )
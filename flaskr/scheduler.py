@@ -0,0 +1,228 @@
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import click
+from flask import current_app
+
+from .db import get_db
+
+Job = namedtuple('Job', 'name func interval description')
+
+# Up to this fraction of a job's interval is added to its first run so jobs
+# don't all start together after a deploy
+FIRST_RUN_JITTER = 0.1
+
+_start_lock = threading.Lock()
+
+
+def init_app(app):
+    app.extensions['jobs'] = {}
+    app.before_request(start_scheduler)
+    app.cli.add_command(list_jobs_command)
+    app.cli.add_command(run_job_command)
+
+
+def register_job(app, name, interval, func, description=''):
+    """Run `func` inside an app context every `interval` seconds.
+
+    JOB_INTERVALS in the config overrides the interval by job name.
+    """
+    interval = app.config['JOB_INTERVALS'].get(name, interval)
+    app.extensions['jobs'][name] = Job(name, func, interval, description)
+
+
+def run_job(app, name):
+    """Run one job now and record its runtime. Returns the error message, if any."""
+    job = app.extensions['jobs'][name]
+    with app.app_context():
+        db = get_db()
+        started = time.time()
+        try:
+            db.execute(
+                'INSERT INTO job_status (name, next_run, last_started, last_status) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (name) DO UPDATE SET next_run = excluded.next_run, '
+                'last_started = excluded.last_started, last_status = excluded.last_status',
+                (name, started + job.interval, started, 'running')
+            )
+            db.commit()
+        except sqlite3.Error as e:
+            # Skip the run; the job is still due, so the next tick retries it
+            db.rollback()
+            app.logger.error(f"Job {name} not started, could not record its status: {e}")
+            return str(e)
+
+        error = None
+        try:
+            job.func()
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            app.logger.exception(f"Job {name} failed")
+        duration = time.time() - started
+
+        try:
+            db.execute(
+                'UPDATE job_status SET last_duration = ?, last_status = ?, last_error = ?, '
+                'runs = runs + 1, failures = failures + ?, total_duration = total_duration + ?, '
+                'max_duration = MAX(max_duration, ?) WHERE name = ?',
+                (duration, 'failed' if error else 'ok', error, 1 if error else 0, duration, duration, name)
+            )
+            db.commit()
+        except sqlite3.Error as e:
+            db.rollback()
+            app.logger.error(f"Job {name} {'failed' if error else 'finished'} but its status was not recorded: {e}")
+            return error or str(e)
+        app.logger.info(f"Job {name} finished in {duration:.2f}s")
+    return error
+
+
+def acquire_leadership(owner):
+    """Take or renew the scheduler lease. Only the lease holder runs scheduled jobs."""
+    db = get_db()
+    now = time.time()
+    db.execute('BEGIN IMMEDIATE')
+    lease = db.execute('SELECT owner, expires FROM scheduler_lease WHERE id = 1').fetchone()
+    leader = lease is None or lease['owner'] == owner or lease['expires'] < now
+    if leader:
+        db.execute(
+            'INSERT OR REPLACE INTO scheduler_lease (id, owner, expires) VALUES (1, ?, ?)',
+            (owner, now + current_app.config['SCHEDULER_LEASE_SECONDS'])
+        )
+    db.commit()
+    return leader
+
+
+def release_leadership(owner):
+    db = get_db()
+    db.execute('DELETE FROM scheduler_lease WHERE id = 1 AND owner = ?', (owner,))
+    db.commit()
+
+
+def due_jobs():
+    """Jobs whose next run time has passed.
+
+    A job seen for the first time is scheduled one interval (plus jitter) from
+    now rather than run straight away.
+    """
+    db = get_db()
+    jobs = current_app.extensions['jobs']
+    now = time.time()
+    db.executemany(
+        'INSERT OR IGNORE INTO job_status (name, next_run) VALUES (?, ?)',
+        [(job.name, now + job.interval * (1 + random.uniform(0, FIRST_RUN_JITTER))) for job in jobs.values()]
+    )
+    db.commit()
+    next_run = {row['name']: row['next_run'] for row in db.execute('SELECT name, next_run FROM job_status')}
+    return [job for job in jobs.values() if next_run[job.name] is None or next_run[job.name] <= now]
+
+
+def _owner():
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+
+def _job_done(app, name, running, future):
+    running.discard(name)
+    if future.exception() is not None:
+        app.logger.error(f"Job {name} crashed", exc_info=future.exception())
+
+
+def _scheduler_loop(app):
+    owner = _owner()
+    executor = ThreadPoolExecutor(max_workers=app.config['SCHEDULER_WORKERS'], thread_name_prefix='job')
+    running = set()
+
+    while True:
+        try:
+            with app.app_context():
+                if acquire_leadership(owner):
+                    for job in due_jobs():
+                        if job.name in running:
+                            continue
+                        running.add(job.name)
+                        future = executor.submit(run_job, app, job.name)
+                        future.add_done_callback(partial(_job_done, app, job.name, running))
+        except sqlite3.Error as e:
+            app.logger.error(f"Scheduler tick failed: {e}")
+        time.sleep(app.config['SCHEDULER_TICK'])
+
+
+def start_scheduler():
+    app = current_app._get_current_object()
+    if not app.config['SCHEDULER_ENABLED'] or app.extensions.get('scheduler'):
+        return
+
+    with _start_lock:
+        if app.extensions.get('scheduler'):
+            return
+        thread = threading.Thread(target=_scheduler_loop, args=(app,), name='scheduler', daemon=True)
+        app.extensions['scheduler'] = thread
+        thread.start()
+        app.logger.info("Scheduler started")
+
+
+@click.command('list-jobs')
+def list_jobs_command():
+    """List scheduled jobs and their last run."""
+    status = {row['name']: row for row in get_db().execute('SELECT * FROM job_status')}
+    for job in current_app.extensions['jobs'].values():
+        row = status.get(job.name)
+        last = 'never run' if row is None or row['last_duration'] is None else (
+            f"{row['last_status']} in {row['last_duration']:.2f}s, {row['runs']} runs, {row['failures']} failed"
+        )
+        click.echo(f'{job.name:<16} every {job.interval}s  {last}')
+
+
+@click.command('run-job')
+@click.argument('names', nargs=-1)
+@click.option('--all', 'run_all', is_flag=True, help='Run every registered job.')
+def run_job_command(names, run_all):
+    """Run jobs now, whether or not they are due.
+
+    If a running app holds the scheduler lease, the jobs are queued for it
+    instead so they never run in two processes at once.
+    """
+    app = current_app._get_current_object()
+    if run_all:
+        names = list(app.extensions['jobs'])
+    unknown = [name for name in names if name not in app.extensions['jobs']]
+    if unknown:
+        raise click.BadParameter(f"unknown job(s): {', '.join(unknown)}")
+
+    owner = _owner()
+    if not acquire_leadership(owner):
+        db = get_db()
+        db.executemany(
+            'INSERT INTO job_status (name, next_run) VALUES (?, 0) ON CONFLICT (name) DO UPDATE SET next_run = 0',
+            [(name,) for name in names]
+        )
+        db.commit()
+        for name in names:
+            click.echo(f'{name}: queued for the scheduler')
+        return
+
+    # Keep the lease while the jobs run, however long they take
+    stop = threading.Event()
+    def renew():
+        while not stop.wait(app.config['SCHEDULER_LEASE_SECONDS'] / 3):
+            try:
+                with app.app_context():
+                    acquire_leadership(owner)
+            except sqlite3.Error as e:
+                app.logger.error(f"Scheduler lease renewal failed: {e}")
+    renewer = threading.Thread(target=renew, name='lease', daemon=True)
+    renewer.start()
+    try:
+        for name in names:
+            error = run_job(app, name)
+            click.echo(f'{name}: {"failed: " + error if error else "ok"}')
+    finally:
+        stop.set()
+        renewer.join()
+        release_leadership(owner)
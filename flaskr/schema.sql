@@ -1,6 +1,14 @@
 DROP TABLE IF EXISTS user;
 DROP TABLE IF EXISTS joke;
 DROP TABLE IF EXISTS joke_taken;
+DROP TABLE IF EXISTS joke_rating;
+DROP TABLE IF EXISTS id_sequence;
+DROP TABLE IF EXISTS user_directory;
+DROP TABLE IF EXISTS joke_signature;
+DROP TABLE IF EXISTS joke_lsh;
+DROP TABLE IF EXISTS joke_cluster;
+DROP TABLE IF EXISTS scheduler_lease;
+DROP TABLE IF EXISTS job_status;
 
 CREATE TABLE user (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -30,3 +38,67 @@ CREATE TABLE joke_taken (
     FOREIGN KEY (joke_id) REFERENCES joke (id),
     PRIMARY KEY (user_id, joke_id)
 );
+
+CREATE TABLE joke_rating (
+    joke_id INTEGER PRIMARY KEY,
+    rating_total INTEGER NOT NULL,
+    rating_count INTEGER NOT NULL,
+    FOREIGN KEY (joke_id) REFERENCES joke (id)
+);
+
+CREATE TABLE id_sequence (
+    tbl TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    next_k INTEGER NOT NULL,
+    PRIMARY KEY (tbl, bucket)
+);
+
+CREATE TABLE user_directory (
+    user_id INTEGER PRIMARY KEY,
+    email TEXT UNIQUE NOT NULL,
+    nickname TEXT UNIQUE NOT NULL
+);
+
+CREATE TABLE joke_signature (
+    joke_id INTEGER PRIMARY KEY,
+    body_hash INTEGER NOT NULL,
+    signature BLOB NOT NULL,
+    FOREIGN KEY (joke_id) REFERENCES joke (id)
+);
+
+CREATE INDEX joke_signature_body_hash ON joke_signature (body_hash);
+
+CREATE TABLE joke_lsh (
+    band INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    joke_id INTEGER NOT NULL,
+    PRIMARY KEY (band, bucket, joke_id)
+) WITHOUT ROWID;
+
+CREATE INDEX joke_lsh_joke_id ON joke_lsh (joke_id);
+
+CREATE TABLE joke_cluster (
+    joke_id INTEGER PRIMARY KEY,
+    cluster INTEGER NOT NULL
+);
+
+CREATE INDEX joke_cluster_cluster ON joke_cluster (cluster);
+
+CREATE TABLE scheduler_lease (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    owner TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+
+CREATE TABLE job_status (
+    name TEXT PRIMARY KEY,
+    next_run REAL,
+    last_started REAL,
+    last_duration REAL,
+    last_status TEXT,
+    last_error TEXT,
+    runs INTEGER NOT NULL DEFAULT 0,
+    failures INTEGER NOT NULL DEFAULT 0,
+    total_duration REAL NOT NULL DEFAULT 0,
+    max_duration REAL NOT NULL DEFAULT 0
+);
@@ -0,0 +1,385 @@
+import heapq
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from flask import Flask, current_app, g
+
+from .db import get_db
+
+# Every table that moves with a bucket, and the id column that decides the bucket
+BUCKET_COLUMNS = (
+    ('user', 'id'),
+    ('joke', 'id'),
+    ('joke_taken', 'user_id'),
+    ('joke_rating', 'joke_id'),
+    ('joke_signature', 'joke_id'),
+    ('joke_lsh', 'joke_id'),
+)
+
+
+def init_app(app):
+    app.teardown_appcontext(close_shards)
+    app.cli.add_command(rebalance_shards_command)
+    app.cli.add_command(shard_bench_command)
+
+
+def shard_file(base, index):
+    """Path of shard `index` for a database file; shard 0 is the file itself."""
+    if index == 0:
+        return base
+    root, ext = os.path.splitext(base)
+    return f'{root}-shard{index}{ext}'
+
+
+def load_shard_map(app):
+    """Bucket -> shard assignment. Without a map file every bucket lives on shard 0."""
+    path = app.config['SHARD_MAP']
+    if os.path.exists(path):
+        with open(path) as f:
+            buckets = json.load(f)['buckets']
+        if len(buckets) != app.config['SHARD_BUCKETS']:
+            raise RuntimeError(f"Shard map {path} does not match SHARD_BUCKETS")
+        return buckets
+    return [0] * app.config['SHARD_BUCKETS']
+
+
+def shard_map():
+    app = current_app._get_current_object()
+    if 'shard_map' not in app.extensions:
+        app.extensions['shard_map'] = load_shard_map(app)
+    return app.extensions['shard_map']
+
+
+def shard_count():
+    return max(shard_map()) + 1
+
+
+def shard_paths():
+    return [shard_file(current_app.config['DATABASE'], i) for i in range(shard_count())]
+
+
+def bucket_of(id):
+    return (id - 1) % current_app.config['SHARD_BUCKETS']
+
+
+def bucket_for_key(key):
+    """Home bucket for a new user, derived from a stable key such as the email."""
+    return zlib.crc32(key.encode('utf8')) % current_app.config['SHARD_BUCKETS']
+
+
+def _connect(path, readonly=False, check_same_thread=True):
+    if readonly:
+        db = sqlite3.connect(
+            f'file:{path}?mode=ro', uri=True, detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=check_same_thread
+        )
+    else:
+        db = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=check_same_thread)
+        db.execute('PRAGMA journal_mode=WAL')
+    db.row_factory = sqlite3.Row
+    return db
+
+
+def get_shard(index) -> sqlite3.Connection:
+    if index == 0:
+        return get_db()
+
+    if 'shards' not in g:
+        g.shards = {}
+    if index not in g.shards:
+        g.shards[index] = _connect(shard_file(current_app.config['DATABASE'], index))
+
+    return g.shards[index]
+
+
+def all_shards():
+    return [get_shard(i) for i in range(shard_count())]
+
+
+def shard_for_id(id) -> sqlite3.Connection:
+    """Shard holding a user, or a joke (jokes live with their author)."""
+    return get_shard(shard_map()[bucket_of(id)])
+
+
+def close_shards(e=None):
+    for db in g.pop('shards', {}).values():
+        db.close()
+    for db in g.pop('fanout', {}).values():
+        db.close()
+
+
+def allocate_id(db, table, bucket):
+    """Reserve the next id for `table` in `bucket` on the shard that owns the bucket.
+
+    Opens a write transaction on `db`; the caller commits it together with the insert.
+    """
+    buckets = current_app.config['SHARD_BUCKETS']
+    if not db.in_transaction:
+        db.execute('BEGIN IMMEDIATE')
+
+    row = db.execute(
+        'SELECT next_k FROM id_sequence WHERE tbl = ? AND bucket = ?', (table, bucket)
+    ).fetchone()
+    if row is None:
+        max_id = db.execute(
+            f'SELECT MAX(id) FROM {table} WHERE (id - 1) % ? = ?', (buckets, bucket)
+        ).fetchone()[0]
+        k = 0 if max_id is None else (max_id - 1) // buckets + 1
+    else:
+        k = row['next_k']
+
+    db.execute(
+        'INSERT OR REPLACE INTO id_sequence (tbl, bucket, next_k) VALUES (?, ?, ?)',
+        (table, bucket, k + 1)
+    )
+    return k * buckets + bucket + 1
+
+
+def _executor():
+    app = current_app._get_current_object()
+    if 'shard_executor' not in app.extensions:
+        app.extensions['shard_executor'] = ThreadPoolExecutor(
+            max_workers=app.config['SHARD_FANOUT_WORKERS'], thread_name_prefix='shard-fanout'
+        )
+    return app.extensions['shard_executor']
+
+
+def _fanout_connection(path):
+    """Primary-shard connection for fan-out queries, kept for the rest of the app context.
+
+    It is handed to one pool thread at a time, so it is opened without the
+    same-thread check, and closed with the other shard connections.
+    """
+    if 'fanout' not in g:
+        g.fanout = {}
+    if path not in g.fanout:
+        g.fanout[path] = _connect(path, check_same_thread=False)
+    return g.fanout[path]
+
+
+def _query(db, sql, params):
+    return db.execute(sql, params).fetchall()
+
+
+def _query_file(path, sql, params):
+    # Replica files are swapped out on every refresh, so their connections are not kept
+    db = _connect(path, readonly=True)
+    try:
+        return db.execute(sql, params).fetchall()
+    finally:
+        db.close()
+
+
+def fan_out(sql, params=(), order_by=None, reverse=False, paths=None, parallel=True):
+    """Run a read query on every shard in parallel and merge the results.
+
+    Each shard must return its rows already sorted by `order_by`; the lists are
+    then merged in order. `paths` overrides the files to read, e.g. replicas.
+    Index lookups that take microseconds per shard are faster with
+    `parallel=False`, which queries the shards one after another in this thread.
+    """
+    if paths is None:
+        if shard_count() == 1:
+            return get_db().execute(sql, params).fetchall()
+        calls = [(_query, _fanout_connection(path)) for path in shard_paths()]
+    else:
+        calls = [(_query_file, path) for path in paths]
+
+    if len(calls) == 1 or not parallel:
+        results = [func(target, sql, params) for func, target in calls]
+    else:
+        futures = [_executor().submit(func, target, sql, params) for func, target in calls]
+        results = [future.result() for future in futures]
+
+    if order_by is None:
+        return [row for rows in results for row in rows]
+    return list(heapq.merge(*results, key=lambda row: row[order_by], reverse=reverse))
+
+
+def merge_scan(sql, params=(), key=None):
+    """Iterate over a query's rows from every shard, merged by `key`.
+
+    Unlike fan_out, rows are streamed from one cursor per shard rather than
+    loaded, so whole tables can be walked in bounded memory. Each shard must
+    return its rows already sorted by `key`.
+    """
+    return heapq.merge(*(db.execute(sql, params) for db in all_shards()), key=key)
+
+
+def find_one(sql, params=()):
+    """First row matching a lookup that is not keyed by id (e.g. email), on any shard."""
+    rows = fan_out(sql, params)
+    return rows[0] if rows else None
+
+
+def _realign_jokes(db, buckets):
+    """Give jokes created before sharding an id in their author's bucket."""
+    stray = db.execute(
+        'SELECT id, author_id FROM joke WHERE (id - 1) % ? != (author_id - 1) % ?', (buckets, buckets)
+    ).fetchall()
+    for joke in stray:
+        new_id = allocate_id(db, 'joke', bucket_of(joke['author_id']))
+        db.execute('UPDATE joke SET id = ? WHERE id = ?', (new_id, joke['id']))
+        for table in ('joke_taken', 'joke_rating', 'joke_signature', 'joke_lsh'):
+            db.execute(f'UPDATE {table} SET joke_id = ? WHERE joke_id = ?', (new_id, joke['id']))
+    return len(stray)
+
+
+def _move_bucket(src, dst, bucket, buckets):
+    for table, column in BUCKET_COLUMNS:
+        rows = src.execute(
+            f'SELECT * FROM {table} WHERE ({column} - 1) % ? = ?', (buckets, bucket)
+        ).fetchall()
+        if rows:
+            cols = ', '.join(rows[0].keys())
+            marks = ', '.join('?' * len(rows[0].keys()))
+            dst.executemany(f'INSERT OR REPLACE INTO {table} ({cols}) VALUES ({marks})', rows)
+
+    seq = src.execute('SELECT tbl, bucket, next_k FROM id_sequence WHERE bucket = ?', (bucket,)).fetchall()
+    dst.executemany('INSERT OR REPLACE INTO id_sequence (tbl, bucket, next_k) VALUES (?, ?, ?)', seq)
+
+
+def _purge_bucket(db, bucket, buckets):
+    for table, column in reversed(BUCKET_COLUMNS):
+        db.execute(f'DELETE FROM {table} WHERE ({column} - 1) % ? = ?', (buckets, bucket))
+    db.execute('DELETE FROM id_sequence WHERE bucket = ?', (bucket,))
+
+
+@click.command('rebalance-shards')
+@click.argument('count', type=click.IntRange(1))
+def rebalance_shards_command(count):
+    """Spread user data over COUNT shard files. Run while the app is stopped."""
+    app = current_app._get_current_object()
+    buckets = app.config['SHARD_BUCKETS']
+    if count > buckets:
+        raise click.BadParameter(f'cannot use more shards than SHARD_BUCKETS ({buckets})')
+
+    old_map = load_shard_map(app)
+    new_map = [bucket % count for bucket in range(buckets)]
+    moves = [(b, old_map[b], new_map[b]) for b in range(buckets) if old_map[b] != new_map[b]]
+
+    with app.open_resource('schema.sql') as f:
+        schema = f.read().decode('utf8')
+    with app.open_resource('upgrade.sql') as f:
+        upgrade = f.read().decode('utf8')
+
+    base = app.config['DATABASE']
+    conns = {}
+    def connect(index):
+        if index not in conns:
+            conns[index] = _connect(shard_file(base, index))
+            if conns[index].execute("SELECT 1 FROM sqlite_master WHERE name = 'joke'").fetchone() is None:
+                conns[index].executescript(schema)
+            conns[index].executescript(upgrade)
+        return conns[index]
+
+    # Replica snapshots still hold the old bucket layout and would be read alongside the new shards
+    replica_base = app.config.get('REPLICA_DATABASE')
+    if replica_base:
+        for index in range(max(max(old_map), count - 1) + 1):
+            if os.path.exists(shard_file(replica_base, index)):
+                os.remove(shard_file(replica_base, index))
+
+    try:
+        realigned = sum(_realign_jokes(connect(index), buckets) for index in set(old_map))
+        # Clusters refer to joke ids, which may have just changed; the dedup_clusters job rebuilds them
+        connect(0).execute('DELETE FROM joke_cluster')
+        for db in conns.values():
+            db.commit()
+
+        # Copy first and switch the map before deleting, so a crash never loses rows
+        for bucket, src, dst in moves:
+            _move_bucket(connect(src), connect(dst), bucket, buckets)
+        for db in conns.values():
+            db.commit()
+
+        with open(app.config['SHARD_MAP'], 'w') as f:
+            json.dump({'buckets': new_map}, f)
+
+        for bucket, src, dst in moves:
+            _purge_bucket(connect(src), bucket, buckets)
+        for db in conns.values():
+            db.commit()
+    finally:
+        for db in conns.values():
+            db.close()
+
+    app.extensions.pop('shard_map', None)
+    if realigned:
+        click.echo(f'Renumbered {realigned} joke(s) into their author\'s bucket.')
+    click.echo(f'Moved {len(moves)} of {buckets} buckets; now using {count} shard(s).')
+    click.echo('Cleared replicas and duplicate clusters; rebuild with: run-job refresh_replica dedup_clusters')
+
+
+def _bench_writer(paths, buckets, seconds, slot):
+    """Submit jokes for random authors with the same statements as leave_joke."""
+    from .dedup import store_signature
+
+    app = Flask(__name__)
+    app.config['SHARD_BUCKETS'] = buckets
+    shard_of = [bucket % len(paths) for bucket in range(buckets)]
+    conns = [sqlite3.connect(path, timeout=30) for path in paths]
+    for db in conns:
+        db.row_factory = sqlite3.Row
+
+    n = 0
+    with app.app_context():
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            author = random.randrange(buckets) + 1
+            db = conns[shard_of[(author - 1) % buckets]]
+            title = f'bench {slot}-{n}'
+            body = f'joke number {n} from writer {slot} about author {author}'
+            db.execute('SELECT id FROM joke WHERE title = ? AND author_id = ?', (title, author)).fetchone()
+            joke_id = allocate_id(db, 'joke', (author - 1) % buckets)
+            db.execute(
+                'INSERT INTO joke (id, title, body, author_id) VALUES (?, ?, ?, ?)',
+                (joke_id, title, body, author)
+            )
+            store_signature(db, joke_id, body)
+            db.execute('UPDATE user SET joke_balance = joke_balance + 1 WHERE id = ?', (author,))
+            db.commit()
+            n += 1
+
+    for db in conns:
+        db.close()
+    return n
+
+
+@click.command('shard-bench')
+@click.option('--shards', 'shard_counts', multiple=True, type=int, default=(1, 4, 8), show_default=True)
+@click.option('--writers', default=8, help='Concurrent writer processes.')
+@click.option('--seconds', default=5.0, help='Duration of each run.')
+def shard_bench_command(shard_counts, writers, seconds):
+    """Measure joke submission throughput for different shard counts on scratch databases."""
+    buckets = current_app.config['SHARD_BUCKETS']
+    with current_app.open_resource('schema.sql') as f:
+        schema = f.read().decode('utf8')
+
+    for count in shard_counts:
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = [shard_file(os.path.join(tmp, 'bench.sqlite'), i) for i in range(count)]
+            shard_of = [bucket % count for bucket in range(buckets)]
+            for index, path in enumerate(paths):
+                db = sqlite3.connect(path)
+                db.execute('PRAGMA journal_mode=WAL')
+                db.executescript(schema)
+                db.executemany(
+                    'INSERT INTO user (id, email, nickname, password) VALUES (?, ?, ?, ?)',
+                    [(b + 1, f'u{b}@bench', f'u{b}', '-') for b in range(buckets) if shard_of[b] == index]
+                )
+                db.commit()
+                db.close()
+
+            with multiprocessing.get_context('spawn').Pool(writers) as pool:
+                counts = pool.starmap(_bench_writer, [(paths, buckets, seconds, slot) for slot in range(writers)])
+
+            click.echo(f'{count} shard(s): {sum(counts) / seconds:.0f} writes/s')
@@ -0,0 +1,65 @@
+-- Tables added after the first release; safe to run against any existing database.
+
+CREATE TABLE IF NOT EXISTS joke_rating (
+    joke_id INTEGER PRIMARY KEY,
+    rating_total INTEGER NOT NULL,
+    rating_count INTEGER NOT NULL,
+    FOREIGN KEY (joke_id) REFERENCES joke (id)
+);
+
+CREATE TABLE IF NOT EXISTS id_sequence (
+    tbl TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    next_k INTEGER NOT NULL,
+    PRIMARY KEY (tbl, bucket)
+);
+
+CREATE TABLE IF NOT EXISTS user_directory (
+    user_id INTEGER PRIMARY KEY,
+    email TEXT UNIQUE NOT NULL,
+    nickname TEXT UNIQUE NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS joke_signature (
+    joke_id INTEGER PRIMARY KEY,
+    body_hash INTEGER NOT NULL,
+    signature BLOB NOT NULL,
+    FOREIGN KEY (joke_id) REFERENCES joke (id)
+);
+
+CREATE INDEX IF NOT EXISTS joke_signature_body_hash ON joke_signature (body_hash);
+
+CREATE TABLE IF NOT EXISTS joke_lsh (
+    band INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    joke_id INTEGER NOT NULL,
+    PRIMARY KEY (band, bucket, joke_id)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS joke_lsh_joke_id ON joke_lsh (joke_id);
+
+CREATE TABLE IF NOT EXISTS joke_cluster (
+    joke_id INTEGER PRIMARY KEY,
+    cluster INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS joke_cluster_cluster ON joke_cluster (cluster);
+
+CREATE TABLE IF NOT EXISTS scheduler_lease (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    owner TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS job_status (
+    name TEXT PRIMARY KEY,
+    next_run REAL,
+    last_started REAL,
+    last_duration REAL,
+    last_status TEXT,
+    last_error TEXT,
+    runs INTEGER NOT NULL DEFAULT 0,
+    failures INTEGER NOT NULL DEFAULT 0,
+    total_duration REAL NOT NULL DEFAULT 0,
+    max_duration REAL NOT NULL DEFAULT 0
+);
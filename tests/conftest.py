@@ -0,0 +1,31 @@
+import pytest
+
+from flaskr import create_app
+from flaskr.db import init_db
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = create_app({
+        'TESTING': True,
+        'DATABASE': str(tmp_path / 'flaskr.sqlite'),
+        'REPLICA_DATABASE': str(tmp_path / 'flaskr-replica.sqlite'),
+        'SHARD_MAP': str(tmp_path / 'shard_map.json'),
+        'LOG_DIR': str(tmp_path / 'logs'),
+        'SCHEDULER_ENABLED': False,
+    })
+
+    with app.app_context():
+        init_db()
+
+    yield app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def runner(app):
+    return app.test_cli_runner()
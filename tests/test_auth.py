@@ -0,0 +1,27 @@
+from flaskr.auth import create_user, find_user
+from flaskr.shards import bucket_for_key, shard_map
+
+
+def test_nickname_unique_across_shards(app, runner):
+    with app.app_context():
+        runner.invoke(args=['rebalance-shards', '4'])
+        emails = [f'user{i}@example.com' for i in range(20)]
+        first = emails[0]
+        other = next(e for e in emails if shard_map()[bucket_for_key(e)] != shard_map()[bucket_for_key(first)])
+
+        assert create_user(first, 'same', '-') is not None
+        assert create_user(other, 'same', '-') is None
+        assert create_user(first, 'different', '-') is None
+        assert find_user('same')['email'] == first
+
+
+def test_register_and_login(client, app):
+    response = client.post('/auth/register', data={'email': 'a@example.com', 'nickname': 'a', 'password': 'pw'})
+    assert response.status_code == 302
+    response = client.post('/auth/register', data={'email': 'b@example.com', 'nickname': 'a', 'password': 'pw'})
+    assert b'Email or Nickname already exists.' in response.data
+
+    response = client.post('/auth/login', data={'email_or_nickname': 'a', 'password': 'pw'})
+    assert response.headers['Location'] == '/jokes/my_jokes'
+    response = client.post('/auth/login', data={'email_or_nickname': 'a@example.com', 'password': 'pw'})
+    assert response.headers['Location'] == '/jokes/my_jokes'
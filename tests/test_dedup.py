@@ -0,0 +1,69 @@
+from flaskr.auth import create_user
+from flaskr.db import get_db
+from flaskr.dedup import compute_clusters, duplicate_clusters, find_duplicate, store_signature
+from flaskr.shards import allocate_id, bucket_of, shard_for_id
+
+JOKE = 'Why did the scarecrow win an award? Because he was outstanding in his field.'
+
+
+def post(author, body):
+    db = shard_for_id(author)
+    joke_id = allocate_id(db, 'joke', bucket_of(author))
+    db.execute('INSERT INTO joke (id, title, body, author_id) VALUES (?, ?, ?, ?)', (joke_id, 't', body, author))
+    store_signature(db, joke_id, body)
+    db.commit()
+    return joke_id
+
+
+def test_find_duplicate(app):
+    with app.app_context():
+        joke_id = post(create_user('a@example.com', 'a', '-'), JOKE)
+
+        assert find_duplicate(JOKE) == joke_id
+        assert find_duplicate('why did the SCARECROW win an award because he was outstanding in his field!!') == joke_id
+        assert find_duplicate(JOKE, exclude_id=joke_id) is None
+
+
+def test_find_duplicate_one_word_edit(app):
+    with app.app_context():
+        joke_id = post(create_user('a@example.com', 'a', '-'), JOKE)
+
+        assert find_duplicate(JOKE.replace('the scarecrow', 'the old scarecrow')) == joke_id
+        assert find_duplicate(JOKE.replace('award', 'prize')) == joke_id
+
+
+def test_find_duplicate_unrelated(app):
+    with app.app_context():
+        post(create_user('a@example.com', 'a', '-'), JOKE)
+
+        assert find_duplicate('Why did the bicycle fall over? Because it was two tired.') is None
+        assert find_duplicate('I am reading a book about anti-gravity. It is impossible to put down.') is None
+
+
+def test_find_duplicate_emoji_and_empty(app):
+    with app.app_context():
+        joke_id = post(create_user('a@example.com', 'a', '-'), '🐔🛣️')
+
+        assert find_duplicate('🦆🍞') is None
+        assert find_duplicate('🐔🛣️') == joke_id
+        assert find_duplicate('   ') is None
+
+
+def test_clusters_span_shards(app, runner):
+    with app.app_context():
+        runner.invoke(args=['rebalance-shards', '4'])
+        authors = [create_user(f'user{i}@example.com', f'user{i}', '-') for i in range(6)]
+
+        copies = [post(author, JOKE if i % 2 else JOKE.replace('award', 'prize')) for i, author in enumerate(authors[:4])]
+        pair = [post(author, 'What do you call a bear with no teeth? A gummy bear.') for author in authors[4:]]
+        post(authors[0], 'Why did the bicycle fall over? Because it was two tired.')
+
+        compute_clusters()
+        clusters, has_more = duplicate_clusters()
+        assert [sorted(cluster) for cluster in clusters] == [sorted(copies), sorted(pair)]
+        assert not has_more
+
+        first, has_more = duplicate_clusters(page=1, per_page=1)
+        assert (first, has_more) == ([sorted(copies)], True)
+        assert duplicate_clusters(page=2, per_page=1) == ([sorted(pair)], False)
+        assert get_db().execute('SELECT COUNT(*) FROM joke_cluster').fetchone()[0] == 6
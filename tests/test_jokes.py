@@ -0,0 +1,88 @@
+import pytest
+
+from flaskr.maintenance import recompute_ratings
+from flaskr.shards import find_one, shard_for_id
+
+BODIES = [
+    'Why did the scarecrow win an award? Because he was outstanding in his field.',
+    'What do you call fake spaghetti? An impasta.',
+    'Why did the bicycle fall over? Because it was two tired.',
+]
+
+
+def login(app, nickname):
+    client = app.test_client()
+    client.post('/auth/register', data={'email': f'{nickname}@example.com', 'nickname': nickname, 'password': 'pw'})
+    client.post('/auth/login', data={'email_or_nickname': nickname, 'password': 'pw'})
+    return client
+
+
+@pytest.fixture
+def users(app, runner):
+    with app.app_context():
+        runner.invoke(args=['rebalance-shards', '4'])
+    clients = [login(app, f'user{i}') for i in range(len(BODIES))]
+    for i, client in enumerate(clients):
+        client.post('/jokes/leave', data={'title': f'joke {i}', 'body': BODIES[i]})
+    return clients
+
+
+def rating_of(app, title):
+    with app.app_context():
+        joke = find_one('SELECT id FROM joke WHERE title = ?', (title,))
+        db = shard_for_id(joke['id'])
+        rating = db.execute('SELECT rating FROM joke WHERE id = ?', (joke['id'],)).fetchone()['rating']
+        totals = db.execute(
+            'SELECT rating_total, rating_count FROM joke_rating WHERE joke_id = ?', (joke['id'],)
+        ).fetchone()
+        return joke['id'], rating, tuple(totals) if totals else None
+
+
+def test_rating_keeps_running_average(app, users):
+    joke_id, _, _ = rating_of(app, 'joke 0')
+    for client, rating in ((users[1], 5), (users[2], 2)):
+        client.post(f'/jokes/{joke_id}/take')
+        client.post(f'/jokes/{joke_id}/rate', data={'rating': rating}, headers={'Referer': '/'})
+    assert rating_of(app, 'joke 0') == (joke_id, 3.5, (7, 2))
+
+    # Changing a rating replaces the earlier one instead of adding to it
+    users[2].post(f'/jokes/{joke_id}/rate', data={'rating': 4}, headers={'Referer': '/'})
+    assert rating_of(app, 'joke 0') == (joke_id, 4.5, (9, 2))
+
+    with app.app_context():
+        recompute_ratings()
+    assert rating_of(app, 'joke 0') == (joke_id, 4.5, (9, 2))
+
+
+def test_rating_requires_take(app, users):
+    joke_id, _, _ = rating_of(app, 'joke 0')
+    users[1].post(f'/jokes/{joke_id}/rate', data={'rating': 5}, headers={'Referer': '/'})
+    assert rating_of(app, 'joke 0')[2] is None
+
+
+def test_ratings_job_repairs_drift(app, users):
+    joke_id, _, _ = rating_of(app, 'joke 0')
+    users[1].post(f'/jokes/{joke_id}/take')
+    users[1].post(f'/jokes/{joke_id}/rate', data={'rating': 5}, headers={'Referer': '/'})
+    with app.app_context():
+        db = shard_for_id(joke_id)
+        db.execute('UPDATE joke_rating SET rating_total = 1, rating_count = 3 WHERE joke_id = ?', (joke_id,))
+        db.execute('UPDATE joke SET rating = 0 WHERE id = ?', (joke_id,))
+        db.commit()
+        recompute_ratings()
+    assert rating_of(app, 'joke 0') == (joke_id, 5.0, (5, 1))
+
+
+def test_upgrade_db_seeds_rating_totals(app, users, runner):
+    joke_id, _, _ = rating_of(app, 'joke 0')
+    users[1].post(f'/jokes/{joke_id}/take')
+    users[1].post(f'/jokes/{joke_id}/rate', data={'rating': 3}, headers={'Referer': '/'})
+    with app.app_context():
+        db = shard_for_id(joke_id)
+        db.execute('DROP TABLE joke_rating')
+        db.commit()
+        runner.invoke(args=['upgrade-db'])
+    assert rating_of(app, 'joke 0') == (joke_id, 3.0, (3, 1))
+
+    users[1].post(f'/jokes/{joke_id}/rate', data={'rating': 5}, headers={'Referer': '/'})
+    assert rating_of(app, 'joke 0') == (joke_id, 5.0, (5, 1))
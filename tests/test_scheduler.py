@@ -0,0 +1,60 @@
+import logging
+from concurrent.futures import Future
+
+from flaskr.db import get_db
+from flaskr.scheduler import _job_done, acquire_leadership, due_jobs, register_job, run_job
+
+
+def test_lease_has_one_owner(app):
+    with app.app_context():
+        assert acquire_leadership('a')
+        assert not acquire_leadership('b')
+        assert acquire_leadership('a')
+        get_db().execute('UPDATE scheduler_lease SET expires = 0')
+        get_db().commit()
+        assert acquire_leadership('b')
+
+
+def test_new_jobs_wait_one_interval(app, runner):
+    with app.app_context():
+        assert due_jobs() == []
+        # Another process holds the lease, so run-job queues the job for it
+        acquire_leadership('other')
+        result = runner.invoke(args=['run-job', 'vacuum'])
+        assert 'queued' in result.output
+        assert [job.name for job in due_jobs()] == ['vacuum']
+
+
+def test_run_job_records_failure(app):
+    def broken():
+        raise ValueError('boom')
+    register_job(app, 'broken', 60, broken)
+
+    assert run_job(app, 'broken') == 'boom'
+    with app.app_context():
+        row = get_db().execute('SELECT * FROM job_status WHERE name = ?', ('broken',)).fetchone()
+    assert (row['last_status'], row['last_error'], row['runs'], row['failures']) == ('failed', 'boom', 1, 1)
+
+
+def test_run_job_reports_bookkeeping_errors(app, caplog):
+    calls = []
+    register_job(app, 'counted', 60, lambda: calls.append(1))
+    with app.app_context():
+        get_db().execute('DROP TABLE job_status')
+        get_db().commit()
+
+    with caplog.at_level(logging.ERROR):
+        assert 'job_status' in run_job(app, 'counted')
+    assert calls == []
+    assert 'Job counted not started' in caplog.text
+
+
+def test_job_done_logs_crash(app, caplog):
+    running = {'crashy'}
+    future = Future()
+    future.set_exception(RuntimeError('lost'))
+
+    with caplog.at_level(logging.ERROR):
+        _job_done(app, 'crashy', running, future)
+    assert running == set()
+    assert 'Job crashy crashed' in caplog.text
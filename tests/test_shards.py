@@ -0,0 +1,157 @@
+from datetime import datetime, timedelta
+
+from flaskr.auth import create_user
+from flaskr.db import get_db
+from flaskr.dedup import store_signature
+from flaskr.shards import (
+    allocate_id, all_shards, bucket_of, fan_out, shard_count, shard_for_id, shard_map
+)
+
+BODIES = [
+    'Why did the scarecrow win an award? Because he was outstanding in his field.',
+    "I'm reading a book about anti-gravity. It's impossible to put down.",
+    "Why don't skeletons fight each other? They don't have the guts.",
+    'What do you call fake spaghetti? An impasta.',
+    'Why did the bicycle fall over? Because it was two tired.',
+    "Parallel lines have so much in common. It's a shame they'll never meet.",
+    "I would tell you a construction joke, but I'm still working on it.",
+    'What do you call a bear with no teeth? A gummy bear.',
+]
+
+
+def rebalance(app, runner, count):
+    result = runner.invoke(args=['rebalance-shards', str(count)])
+    assert result.exception is None, result.output
+    return result
+
+
+def counts():
+    return {
+        table: sum(row['n'] for row in fan_out(f'SELECT COUNT(*) as n FROM {table}'))
+        for table in ('user', 'joke', 'joke_taken', 'joke_signature', 'joke_lsh')
+    }
+
+
+def populate_legacy(app):
+    """Users, jokes and takes as a database from before sharding holds them: joke ids from AUTOINCREMENT."""
+    with app.app_context():
+        users = [create_user(f'user{i}@example.com', f'user{i}', '-') for i in range(len(BODIES))]
+        db = get_db()
+        for author, body in zip(users, BODIES):
+            joke_id = db.execute(
+                'INSERT INTO joke (title, body, author_id) VALUES (?, ?, ?)', (f'joke by {author}', body, author)
+            ).lastrowid
+            store_signature(db, joke_id, body)
+        # Every user takes the next user's joke; the i-th joke got id i + 1
+        db.executemany(
+            'INSERT INTO joke_taken (user_id, joke_id, rating) VALUES (?, ?, 4)',
+            [(user, (i + 1) % len(users) + 1) for i, user in enumerate(users)]
+        )
+        db.commit()
+        return users
+
+
+def taken_bodies():
+    """(taker, body of the taken joke) for every take, resolved on the joke's shard."""
+    result = set()
+    for take in fan_out('SELECT user_id, joke_id FROM joke_taken'):
+        joke = shard_for_id(take['joke_id']).execute(
+            'SELECT body FROM joke WHERE id = ?', (take['joke_id'],)
+        ).fetchone()
+        assert joke is not None, f"take by {take['user_id']} points at missing joke {take['joke_id']}"
+        result.add((take['user_id'], joke['body']))
+    return result
+
+
+def test_allocate_id_stays_in_bucket(app):
+    buckets = app.config['SHARD_BUCKETS']
+    with app.app_context():
+        db = get_db()
+        ids = []
+        for _ in range(3):
+            ids.append(allocate_id(db, 'joke', 5))
+            db.commit()
+        assert ids == [6, 6 + buckets, 6 + 2 * buckets]
+        assert {bucket_of(id) for id in ids} == {5}
+
+
+def test_allocate_id_continues_after_existing_rows(app):
+    buckets = app.config['SHARD_BUCKETS']
+    with app.app_context():
+        db = get_db()
+        user = create_user('a@example.com', 'a', '-')
+        db.execute(
+            'INSERT INTO joke (id, title, body, author_id) VALUES (?, ?, ?, ?)', (7 + 3 * buckets, 't', 'b', user)
+        )
+        db.commit()
+        assert allocate_id(db, 'joke', 6) == 7 + 4 * buckets
+
+
+def test_rebalance_preserves_rows_and_takes(app, runner):
+    users = populate_legacy(app)
+    with app.app_context():
+        before = counts()
+        takes = taken_bodies()
+
+        result = rebalance(app, runner, 4)
+        assert 'Renumbered' in result.output
+        assert shard_count() == 4
+        assert counts() == before
+        assert taken_bodies() == takes
+
+        # Jokes now share their author's bucket, and every row sits on the shard its bucket maps to
+        for joke in fan_out('SELECT id, author_id FROM joke'):
+            assert bucket_of(joke['id']) == bucket_of(joke['author_id'])
+        for index, db in enumerate(all_shards()):
+            for row in db.execute('SELECT id FROM user'):
+                assert shard_map()[bucket_of(row['id'])] == index
+
+        rebalance(app, runner, 1)
+        assert shard_count() == 1
+        assert counts() == before
+        assert taken_bodies() == takes
+        assert len({shard_map()[bucket_of(user)] for user in users}) == 1
+
+
+def test_ids_allocated_after_rebalance_are_unique(app, runner):
+    populate_legacy(app)
+    with app.app_context():
+        rebalance(app, runner, 4)
+        existing = {row['id'] for row in fan_out('SELECT id FROM joke')}
+        author = fan_out('SELECT id FROM user')[0]['id']
+        db = shard_for_id(author)
+        new_id = allocate_id(db, 'joke', bucket_of(author))
+        db.commit()
+        assert new_id not in existing
+        assert shard_for_id(new_id) is db
+
+
+def test_fan_out_merges_by_created(app, runner):
+    with app.app_context():
+        rebalance(app, runner, 4)
+        users = [create_user(f'user{i}@example.com', f'user{i}', '-') for i in range(8)]
+        assert len({shard_map()[bucket_of(user)] for user in users}) > 1
+
+        start = datetime(2024, 1, 1)
+        for i, user in enumerate(users):
+            db = shard_for_id(user)
+            db.execute(
+                'INSERT INTO joke (id, title, body, author_id, created) VALUES (?, ?, ?, ?, ?)',
+                (allocate_id(db, 'joke', bucket_of(user)), f't{i}', 'b', user, start + timedelta(minutes=i))
+            )
+            db.commit()
+
+        jokes = fan_out('SELECT title, created FROM joke ORDER BY created DESC', order_by='created', reverse=True)
+        assert [joke['title'] for joke in jokes] == [f't{i}' for i in reversed(range(8))]
+
+
+def test_rebalance_clears_replicas_and_clusters(app, runner, tmp_path):
+    populate_legacy(app)
+    with app.app_context():
+        assert runner.invoke(args=['sync-replica']).exception is None
+        get_db().execute('INSERT INTO joke_cluster (joke_id, cluster) VALUES (1, 1), (2, 1)')
+        get_db().commit()
+
+        rebalance(app, runner, 4)
+        assert not (tmp_path / 'flaskr-replica.sqlite').exists()
+        assert get_db().execute('SELECT COUNT(*) FROM joke_cluster').fetchone()[0] == 0